@@ -1,16 +1,38 @@
+import asyncio
+import json
 from datetime import date, timedelta
 from enum import Enum
-from typing import Any, Dict, Optional, cast
+from functools import cached_property, lru_cache
+from types import MappingProxyType
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Mapping,
+    Optional,
+    Tuple,
+    cast,
+)
+
+from httpx import TransportError
+from orjson import loads as json_loads
+from starlette.datastructures import MutableHeaders
 
 from hibiapi.api.pixiv.constants import PixivConstants
 from hibiapi.api.pixiv.net import NetRequest as PixivNetClient
-from hibiapi.utils.cache import cache_config
-from hibiapi.utils.decorators import enum_auto_doc
+from hibiapi.utils.cache import cache_config, disable_cache
+from hibiapi.utils.decorators import Retry, enum_auto_doc
+from hibiapi.utils.exceptions import BaseServerException
 from hibiapi.utils.net import catch_network_error
-from hibiapi.utils.routing import BaseEndpoint, dont_route, request_headers
+from hibiapi.utils.routing import (
+    BaseEndpoint,
+    dont_route,
+    request_headers,
+    response_headers,
+)
 
-import json
-import re
 
 @enum_auto_doc
 class IllustType(str, Enum):
@@ -107,70 +129,233 @@ class SearchDurationType(str, Enum):
 
 
 class RankingDate(date):
+    __slots__ = ()
+
     @classmethod
     def yesterday(cls) -> "RankingDate":
         yesterday = cls.today() - timedelta(days=1)
         return cls(yesterday.year, yesterday.month, yesterday.day)
 
     def toString(self) -> str:
-        return self.strftime(r"%Y-%m-%d")
+        return self.isoformat()
 
     @classmethod
     def new(cls, date: date) -> "RankingDate":
+        if isinstance(date, cls):
+            return date
         return cls(date.year, date.month, date.day)
 
 
+_yesterday_cache: Optional[Tuple[date, str]] = None
+
+
+def _yesterday_str() -> str:
+    global _yesterday_cache
+    today = date.today()
+    if _yesterday_cache is None or _yesterday_cache[0] != today:
+        _yesterday_cache = (today, RankingDate.yesterday().toString())
+    return _yesterday_cache[1]
+
+
+_ACCEPT_LANGUAGE_MAX_LENGTH = 512
+
+
+@lru_cache(maxsize=1024)
+def _parse_accept_language(accept_language: str) -> str:
+    if "," not in accept_language and ";" not in accept_language:
+        return accept_language.strip().lower()
+    return accept_language.split(",", 1)[0].split(";", 1)[0].strip().lower()
+
+
+def _offset(page: int, size: int) -> int:
+    return (page - 1) * size if page > 1 else 0
+
+
+@lru_cache(maxsize=256)
+def _parse_params(params: str) -> Mapping[str, Any]:
+    return MappingProxyType(json_loads(params))
+
+
+@lru_cache(maxsize=None)
+def _app_url(endpoint: str) -> str:
+    return f"{PixivConstants.APP_HOST.rstrip('/')}/{endpoint.lstrip('/')}"
+
+
+_inflight_requests: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+
+def _inflight_done(key: Hashable, task: "asyncio.Future[Any]") -> None:
+    _inflight_requests.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # mark as retrieved even if every waiter went away
+
+
+async def _coalesce(key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    # Concurrent identical requests share a single upstream call
+    try:
+        task = _inflight_requests.get(key)
+    except TypeError:  # unhashable param values, skip coalescing
+        return await fetch()
+    if task is None:
+        task = _inflight_requests[key] = asyncio.ensure_future(fetch())
+        task.add_done_callback(lambda t: _inflight_done(key, t))
+    return await asyncio.shield(task)
+
+
+_json_decoder = json.JSONDecoder()
+
+
+def _extract_novel(page: str) -> Dict[str, Any]:
+    position = 0
+    while (position := page.find("novel:", position)) != -1:
+        position += len("novel:")
+        head = page[position : position + 2]
+        if len(head) == 2 and head[0].isspace() and head[1] == "{":
+            novel, _ = _json_decoder.raw_decode(page, position + 1)
+            return novel
+    raise ValueError("novel payload not found")
+
+
+async def _bundle_part(call: Awaitable[Any]) -> Tuple[Any, Optional[int]]:
+    # Runs as its own task, so the part's cache headers stay out of the response
+    response_headers.set(headers := MutableHeaders())
+    result = await call
+    cache_control = headers.get("Cache-Control", "")
+    if not cache_control.startswith("max-age="):
+        return result, None
+    return result, int(cache_control[len("max-age=") :])
+
+
+def _bundle_error(e: Exception) -> Dict[str, Any]:
+    if isinstance(e, BaseServerException):
+        return {"error": e.data.detail, "code": e.data.code}
+    return {"error": "%s" % e}
+
+
+_EMPTY_PARAMS: Mapping[str, Any] = MappingProxyType({})
+
+
 class PixivEndpoints(BaseEndpoint):
-    @staticmethod
-    def _parse_accept_language(accept_language: str) -> str:
-        first_language, *_ = accept_language.partition(",")
-        language_code, *_ = first_language.partition(";")
-        return language_code.lower().strip()
+    @cached_property
+    def _net(self) -> PixivNetClient:
+        return cast(PixivNetClient, self.client.net_client)
+
+    def _headers(self) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        if user := self._net.user:
+            headers["Authorization"] = user.authorization
+        if (incoming := request_headers.get(None)) is not None and (
+            language := incoming.get("Accept-Language")
+        ):
+            headers["Accept-Language"] = _parse_accept_language(
+                language[:_ACCEPT_LANGUAGE_MAX_LENGTH]
+            )
+        return headers
 
     @dont_route
     @catch_network_error
     async def request(
-        self, endpoint: str, *, params: Optional[Dict[str, Any]] = None, return_text: bool = False
+        self,
+        endpoint: str,
+        *,
+        params: Optional[Mapping[str, Any]] = None,
+        return_text: bool = False,
     ) -> Dict[str, Any]:
-        headers = self.client.headers.copy()
-        if user := cast(PixivNetClient, self.client.net_client).user:
-            headers["Authorization"] = f"Bearer {user.access_token}"
-        if language := request_headers.get().get("Accept-Language"):
-            language = self._parse_accept_language(language)
-            headers["Accept-Language"] = language
+        headers = self._headers()
+        query: Mapping[str, Any] = _EMPTY_PARAMS
+        if params:
+            query = {
+                k: (v.value if isinstance(v, Enum) else v)
+                for k, v in params.items()
+                if v is not None
+            }
+
+        key = (
+            endpoint,
+            tuple(sorted(query.items())) if query else (),
+            headers.get("Accept-Language"),
+            return_text,
+        )
+        return await _coalesce(
+            key, lambda: self._fetch(endpoint, query, headers, return_text)
+        )
+
+    async def _fetch(
+        self,
+        endpoint: str,
+        query: Mapping[str, Any],
+        headers: Dict[str, str],
+        return_text: bool,
+    ) -> Any:
         response = await self.client.get(
-            self._join(
-                base=PixivConstants.APP_HOST,
-                endpoint=endpoint,
-                params=params or {},
-            ),
-            headers=headers,
+            _app_url(endpoint),
+            params=query or None,
+            headers=headers or None,
         )
         if return_text:
             return response.text
-        return response.json()
+        return json_loads(response.content)
+
+    @catch_network_error
+    async def _stream_novel(self, params: Mapping[str, Any]) -> Dict[str, Any]:
+        headers = self._headers()
+        key = (
+            "webview/v2/novel",
+            tuple(sorted(params.items())),
+            headers.get("Accept-Language"),
+            "stream",
+        )
+        return await _coalesce(key, lambda: self._fetch_novel(params, headers))
+
+    @Retry(exceptions=[TransportError])
+    async def _fetch_novel(
+        self, params: Mapping[str, Any], headers: Dict[str, str]
+    ) -> Dict[str, Any]:
+        page, scanned = "", 0
+        async with self.client.stream(
+            "GET",
+            _app_url("webview/v2/novel"),
+            params=params,
+            headers=headers or None,
+        ) as response:
+            async for chunk in response.aiter_text():
+                page += chunk
+                # Only try decoding once the object may be complete
+                if page.find("isOwnWork", scanned) != -1:
+                    try:
+                        return _extract_novel(page)
+                    except ValueError:
+                        pass
+                scanned = max(len(page) - len("isOwnWork"), 0)
+        return _extract_novel(page)
+
+    @dont_route
+    async def warmup(self):
+        return await asyncio.gather(
+            self.walkthrough_illusts(),
+            self.tags(),
+            self.tags_novel(),
+            self.spotlights(),
+            return_exceptions=True,
+        )
 
     @cache_config(ttl=timedelta(minutes=10))
     async def live_list(self, *, page: int = 1, size: int = 30):
         params = { "list_type": "popular" }
         if page > 1:
-            params["offset"] = (page - 1) * size
+            params["offset"] = _offset(page, size)
         return await self.request("v1/live/list", params=params)
 
     @cache_config(ttl=timedelta(minutes=30))
     async def live_detail(self, *, id: str):
       response = await self.client.get(
-        self._join(
-            base="https://sketch.pixiv.net",
-            endpoint="api/lives/%s.json" % id,
-            params={},
-        ),
+        f"{PixivConstants.SKETCH_HOST}/api/lives/{id}.json",
         headers={
           "Referer": "https://sketch.pixiv.net/",
           "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
         },
       )
-      return response.json()
+      return json_loads(response.content)
 
     @cache_config(ttl=timedelta(hours=12))
     async def illust(self, *, id: int):
@@ -189,13 +374,14 @@ class PixivEndpoints(BaseEndpoint):
         include_ranking_illusts: bool = False,
         params: Optional[str] = None,
     ):
-        _params = {
-          "filter": filter,
-          "include_privacy_policy": include_privacy_policy,
-          "include_ranking_illusts": include_ranking_illusts,
-        }
         if params:
-          _params = json.loads(params)
+          _params = _parse_params(params)
+        else:
+          _params = {
+            "filter": filter,
+            "include_privacy_policy": include_privacy_policy,
+            "include_ranking_illusts": include_ranking_illusts,
+          }
         return await self.request(
             "v1/illust/recommended",
             params=_params,
@@ -244,7 +430,7 @@ class PixivEndpoints(BaseEndpoint):
             },
         )
 
-    @cache_config(ttl=timedelta(hours=12))
+    @cache_config(ttl=timedelta(hours=12), stale=timedelta(hours=1))
     async def spotlights(
         self,
         *,
@@ -258,7 +444,7 @@ class PixivEndpoints(BaseEndpoint):
             params={
                 "filter": filter,
                 "category": category,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -295,7 +481,7 @@ class PixivEndpoints(BaseEndpoint):
             "v1/search/user",
             params={
                 "word": word,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -313,7 +499,7 @@ class PixivEndpoints(BaseEndpoint):
             params={
                 "user_id": id,
                 "type": illust_type,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -331,7 +517,7 @@ class PixivEndpoints(BaseEndpoint):
                 "user_id": id,
                 "tag": tag,
                 "restrict": "public",
-                "max_bookmark_id": max_bookmark_id or None,
+                "max_bookmark_id": max_bookmark_id,
             },
         )
 
@@ -341,7 +527,7 @@ class PixivEndpoints(BaseEndpoint):
             "v1/user/following",
             params={
                 "user_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -351,11 +537,11 @@ class PixivEndpoints(BaseEndpoint):
             "v1/user/follower",
             params={
                 "user_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
-    @cache_config(ttl=timedelta(hours=12))
+    @cache_config(ttl=timedelta(hours=12), stale=timedelta(hours=1))
     async def rank(
         self,
         *,
@@ -368,8 +554,8 @@ class PixivEndpoints(BaseEndpoint):
             "v1/illust/ranking",
             params={
                 "mode": mode,
-                "date": RankingDate.new(date or RankingDate.yesterday()).toString(),
-                "offset": (page - 1) * size,
+                "date": RankingDate.new(date).toString() if date else _yesterday_str(),
+                "offset": _offset(page, size),
             },
         )
         if not resp['next_url'] and len(resp.get('illusts', [])) == 0:
@@ -404,11 +590,11 @@ class PixivEndpoints(BaseEndpoint):
                 "end_date": end_date,
                 "duration": duration,
                 "search_ai_type": search_ai_type,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
-    @cache_config(ttl=timedelta(hours=6))
+    @cache_config(ttl=timedelta(hours=6), stale=timedelta(hours=1))
     async def tags(self):
         return await self.request("v1/trending-tags/illust")
 
@@ -418,7 +604,7 @@ class PixivEndpoints(BaseEndpoint):
             "v2/illust/related",
             params={
                 "illust_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -428,7 +614,7 @@ class PixivEndpoints(BaseEndpoint):
             "v1/novel/related",
             params={
                 "novel_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -441,17 +627,62 @@ class PixivEndpoints(BaseEndpoint):
             },
         )
 
+    @disable_cache
+    async def illust_bundle(self, *, id: int, include_comments: bool = True):
+        jobs = {
+            "illust": self.illust(id=id),
+            "related": self.related(id=id),
+        }
+        if include_comments:
+            jobs["comments"] = self.illust_comments(id=id)
+        parts: Dict[str, Any] = dict(
+            zip(
+                jobs.keys(),
+                await asyncio.gather(
+                    *map(_bundle_part, jobs.values()), return_exceptions=True
+                ),
+            )
+        )
+        if isinstance(illust := parts["illust"], Exception):
+            raise illust
+        if (illust[0].get("illust") or {}).get("type") == "ugoira":
+            try:
+                parts["ugoira"] = await asyncio.ensure_future(
+                    _bundle_part(self.ugoira_metadata(id=id))
+                )
+            except Exception as e:
+                parts["ugoira"] = e
+
+        bundle: Dict[str, Any] = {}
+        max_age: Optional[int] = None
+        cacheable = True
+        for name, part in parts.items():
+            if isinstance(part, Exception):
+                bundle[name], cacheable = _bundle_error(part), False
+                continue
+            bundle[name], part_max_age = part
+            if part_max_age is None:
+                cacheable = False
+            elif max_age is None or part_max_age < max_age:
+                max_age = part_max_age
+        # The bundle is only as fresh as its stalest part
+        response_headers.get()["Cache-Control"] = (
+            f"max-age={max_age}" if cacheable and max_age is not None else "no-store"
+        )
+        return bundle
+
+    @cache_config(stale=timedelta(hours=1))
     async def walkthrough_illusts(self):
         return await self.request("v1/walkthrough/illusts")
 
     async def illust_series(self, *, id: int, page: int = 1, size: int = 30):
-        return await self.request("v1/illust/series", params={"illust_series_id": id, "offset": (page - 1) * size})
+        return await self.request("v1/illust/series", params={"illust_series_id": id, "offset": _offset(page, size)})
 
     async def member_illust_series(self, *, id: int, page: int = 1, size: int = 30):
-        return await self.request("v1/user/illust-series", params={"user_id": id, "offset": (page - 1) * size})
+        return await self.request("v1/user/illust-series", params={"user_id": id, "offset": _offset(page, size)})
 
     async def member_novel_series(self, *, id: int, page: int = 1, size: int = 30):
-        return await self.request("v1/user/novel-series", params={"user_id": id, "offset": (page - 1) * size})
+        return await self.request("v1/user/novel-series", params={"user_id": id, "offset": _offset(page, size)})
 
     @cache_config(ttl=timedelta(hours=12))
     async def related_member(self, *, id: int):
@@ -469,7 +700,7 @@ class PixivEndpoints(BaseEndpoint):
             "v3/illust/comments",
             params={
                 "illust_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -485,7 +716,7 @@ class PixivEndpoints(BaseEndpoint):
             "v3/novel/comments",
             params={
                 "novel_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -545,8 +776,8 @@ class PixivEndpoints(BaseEndpoint):
             "v1/novel/ranking",
             params={
                 "mode": mode,
-                "date": RankingDate.new(date or RankingDate.yesterday()).toString(),
-                "offset": (page - 1) * size,
+                "date": RankingDate.new(date).toString() if date else _yesterday_str(),
+                "offset": _offset(page, size),
             },
         )
 
@@ -556,7 +787,7 @@ class PixivEndpoints(BaseEndpoint):
             "v1/user/novels",
             params={
                 "user_id": id,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
@@ -591,17 +822,17 @@ class PixivEndpoints(BaseEndpoint):
                 "user_id": id,
                 "restrict": "public",
                 "tag": tag,
-                "max_bookmark_id": max_bookmark_id or None,
+                "max_bookmark_id": max_bookmark_id,
             },
         )
 
-    @cache_config(ttl=timedelta(hours=6))
+    @cache_config(ttl=timedelta(hours=6), stale=timedelta(hours=1))
     async def tags_novel(self):
         return await self.request("v1/trending-tags/novel")
 
     @cache_config(ttl=timedelta(hours=1))
     async def novel_series(self, *, id: int, page: int = 1, size: int = 30):
-        return await self.request("/v2/novel/series", params={"series_id": id, "last_order": (page - 1) * size})
+        return await self.request("/v2/novel/series", params={"series_id": id, "last_order": _offset(page, size)})
 
     @cache_config(ttl=timedelta(hours=12))
     async def novel_detail(self, *, id: int):
@@ -609,20 +840,17 @@ class PixivEndpoints(BaseEndpoint):
 
     @cache_config(ttl=timedelta(hours=12))
     async def webview_novel(self, *, id: int, raw: bool = False):
-        resp = await self.request(
-            "webview/v2/novel",
-            params={
-              "id": id,
-              "viewer_version": "20221031_ai",
-            },
-            return_text=True,
-        )
+        params = {
+          "id": id,
+          "viewer_version": "20221031_ai",
+        }
         if raw:
-          return resp
+          return await self.request(
+              "webview/v2/novel", params=params, return_text=True
+          )
         try:
-          json_str = re.search(r"novel:\s({.+}),\s+isOwnWork", resp).groups()[0].encode()
-          return json.loads(json_str)
-        except Exception as e:
+          return await self._stream_novel(params)
+        except ValueError as e:
           return { "error": "Parse novel error: %s" % e }
 
     @cache_config(ttl=timedelta(hours=12))
@@ -662,7 +890,7 @@ class PixivEndpoints(BaseEndpoint):
                 "end_date": end_date,
                 "duration": duration,
                 "search_ai_type": search_ai_type,
-                "offset": (page - 1) * size,
+                "offset": _offset(page, size),
             },
         )
 
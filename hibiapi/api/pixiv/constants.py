@@ -19,3 +19,4 @@ class PixivConstants:
     APP_HOST: str = "https://app-api.pixiv.net"
     PUB_HOST: str = "https://public-api.secure.pixiv.net"
     AUTH_HOST: str = "https://oauth.secure.pixiv.net"
+    SKETCH_HOST: str = "https://sketch.pixiv.net"
@@ -3,10 +3,10 @@ import hashlib
 import random
 from datetime import datetime
 from itertools import cycle
-from typing import Dict, Optional, Union, cast
+from typing import Any, Dict, Optional, Union, cast
 
-from httpx import URL
-from pydantic import BaseModel, Extra, Field
+from httpx import URL, Limits
+from pydantic import BaseModel, Extra, Field, validator
 
 from hibiapi.utils.log import logger
 from hibiapi.utils.net import BaseNetClient
@@ -33,6 +33,11 @@ class PixivAuthData(AccountDataModel):
     access_token: str
     refresh_token: str
     user: PixivUserData
+    authorization: str = ""
+
+    @validator("authorization", always=True)
+    def _bearer_authorization(cls, value: str, values: Dict[str, Any]) -> str:
+        return f"Bearer {values['access_token']}" if "access_token" in values else value
 
 
 class NetRequest(BaseNetClient):
@@ -42,6 +47,11 @@ class NetRequest(BaseNetClient):
         super().__init__(
             headers=PixivConstants.DEFAULT_HEADERS.copy(),
             proxies=PixivConstants.CONFIG["proxy"].as_dict(),
+            limits=Limits(
+                max_connections=200,
+                max_keepalive_connections=100,
+                keepalive_expiry=60,
+            ),
         )
         self._users: Dict[int, PixivAuthData] = {}
         self.headers["accept-language"] = PixivConstants.CONFIG["language"].as_str()
@@ -2,10 +2,11 @@ import asyncio
 from typing import Optional
 
 from fastapi import Depends, Header
+from starlette.datastructures import Headers, MutableHeaders
 
 from hibiapi.api.pixiv import NetRequest, PixivConstants, PixivEndpoints
 from hibiapi.utils.log import logger
-from hibiapi.utils.routing import EndpointRouter
+from hibiapi.utils.routing import EndpointRouter, request_headers, response_headers
 
 if not PixivConstants.CONFIG["account"]["token"].get():
     logger.warning("Pixiv API token is not set, pixiv endpoint will be unavailable.")
@@ -43,3 +44,37 @@ async def login():
         raise
 
     return
+
+
+warmup_task: Optional["asyncio.Task[None]"] = None
+
+
+async def _warmup():
+    logger.debug("Warming up Pixiv endpoint cache.")
+
+    try:
+        request_headers.set(Headers())
+        response_headers.set(MutableHeaders())
+
+        async with api_root as client:
+            results = await PixivEndpoints(client).warmup()
+    except Exception as e:
+        logger.opt(exception=e).warning("Failed to warm up Pixiv cache:")
+        return
+
+    for result in results:
+        if isinstance(result, Exception):
+            logger.opt(exception=result).warning("Failed to warm up Pixiv cache:")
+
+
+@router.on_event("startup")
+async def warmup():
+    global warmup_task
+    # Runs in background, startup should not wait for the upstream API
+    warmup_task = asyncio.create_task(_warmup())
+
+
+@router.on_event("shutdown")
+async def cancel_warmup():
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 from datetime import timedelta
 from functools import wraps
@@ -18,6 +19,7 @@ T_AsyncFunc = TypeVar("T_AsyncFunc", bound=AsyncFunc)
 
 CACHE_ENABLED = Config["cache"]["enabled"].as_bool()
 CACHE_DELTA = timedelta(seconds=Config["cache"]["ttl"].as_number())
+CACHE_STALE = timedelta(seconds=Config["cache"]["stale"].as_number())
 CACHE_URI = Config["cache"]["uri"].as_str()
 CACHE_CONTROLLABLE = Config["cache"]["controllable"].as_bool()
 
@@ -36,6 +38,7 @@ class CacheConfig(BaseModel):
     namespace: str
     enabled: bool = True
     ttl: timedelta = CACHE_DELTA
+    stale: timedelta = CACHE_STALE
 
     @staticmethod
     def new(
@@ -43,12 +46,14 @@ class CacheConfig(BaseModel):
         *,
         enabled: bool = True,
         ttl: timedelta = CACHE_DELTA,
+        stale: timedelta = CACHE_STALE,
         namespace: Optional[str] = None,
     ):
         return CacheConfig(
             endpoint=function,
             enabled=enabled,
             ttl=ttl,
+            stale=stale,
             namespace=namespace or function.__qualname__,
         )
 
@@ -56,13 +61,16 @@ class CacheConfig(BaseModel):
 def cache_config(
     enabled: bool = True,
     ttl: timedelta = CACHE_DELTA,
+    stale: timedelta = CACHE_STALE,
     namespace: Optional[str] = None,
 ):
     def decorator(function: T_AsyncFunc) -> T_AsyncFunc:
         setattr(
             function,
             CACHE_CONFIG_KEY,
-            CacheConfig.new(function, enabled=enabled, ttl=ttl, namespace=namespace),
+            CacheConfig.new(
+                function, enabled=enabled, ttl=ttl, stale=stale, namespace=namespace
+            ),
         )
         return function
 
@@ -71,6 +79,8 @@ def cache_config(
 
 disable_cache = cache_config(enabled=False)
 
+revalidating: Dict[str, "asyncio.Task[None]"] = {}
+
 
 class CachedValidatedFunction(ValidatedFunction):
     def serialize(self, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> BaseModel:
@@ -89,6 +99,20 @@ def endpoint_cache(function: T_AsyncFunc) -> T_AsyncFunc:
 
     config.enabled = CACHE_ENABLED and config.enabled
 
+    # Calls without arguments always serialize to the same key
+    default_key: Optional[str] = None
+
+    async def revalidate(key: str, model: BaseModel):
+        try:
+            result = await vf.execute(model)
+        except Exception as e:
+            logger.opt(exception=e).warning(
+                f"Failed to revalidate stale cache <b><e>{key}</e></b>:"
+            )
+            return
+        await cache.set(key, result, expire=config.ttl + config.stale)
+        logger.debug(f"Stale cache <b><e>{key}</e></b> revalidated")
+
     @wraps(function)
     async def wrapper(*args, **kwargs):
         cache_policy = "public"
@@ -99,14 +123,23 @@ def endpoint_cache(function: T_AsyncFunc) -> T_AsyncFunc:
         if not config.enabled or cache_policy.casefold() == "no-store":
             return await vf.call(*args, **kwargs)
 
-        key = (
-            f"{config.namespace}:"
-            + hashlib.md5(
-                (model := vf.serialize(args=args, kwargs=kwargs))
-                .json(exclude={"self"}, sort_keys=True, ensure_ascii=False)
-                .encode()
-            ).hexdigest()
-        )
+        nonlocal default_key
+        model: Optional[BaseModel] = None
+        no_arguments = len(args) <= 1 and not kwargs
+
+        if no_arguments and default_key:
+            key = default_key
+        else:
+            key = (
+                f"{config.namespace}:"
+                + hashlib.md5(
+                    (model := vf.serialize(args=args, kwargs=kwargs))
+                    .json(exclude={"self"}, sort_keys=True, ensure_ascii=False)
+                    .encode()
+                ).hexdigest()
+            )
+            if no_arguments:
+                default_key = key
 
         response_header = response_headers.get()
         result: Optional[Any] = None
@@ -118,11 +151,23 @@ def endpoint_cache(function: T_AsyncFunc) -> T_AsyncFunc:
             response_header.setdefault("X-Cache-Hit", key)
 
         if result is None:
+            if model is None:
+                model = vf.serialize(args=args, kwargs=kwargs)
             result = await vf.execute(model)
-            await cache.set(key, result, expire=config.ttl)
+            await cache.set(key, result, expire=config.ttl + config.stale)
+
+        stale_seconds = int(config.stale.total_seconds())
+        cache_remain = await cache.get_expire(key)
+
+        if 0 < cache_remain <= stale_seconds and key not in revalidating:
+            # Serve the stale result, refresh it in background
+            if model is None:
+                model = vf.serialize(args=args, kwargs=kwargs)
+            task = revalidating[key] = asyncio.create_task(revalidate(key, model))
+            task.add_done_callback(lambda _: revalidating.pop(key, None))
 
-        if (cache_remain := await cache.get_expire(key)) > 0:
-            response_header.setdefault("Cache-Control", f"max-age={cache_remain}")
+        if (max_age := cache_remain - stale_seconds) > 0:
+            response_header.setdefault("Cache-Control", f"max-age={max_age}")
 
         return result
 
@@ -19,11 +19,13 @@ from httpx import (
     Cookies,
     HTTPError,
     HTTPStatusError,
+    Limits,
     Request,
     Response,
     ResponseNotRead,
     TransportError,
 )
+from httpx._config import DEFAULT_LIMITS
 
 from .decorators import Retry, TimeIt
 from .exceptions import UpstreamAPIException
@@ -51,15 +53,19 @@ class AsyncHTTPClient(AsyncClient):
             length, code = -1, response.status_code
         logger.debug(
             f"Network request <g>finished</g>: <b><e>{method}</e> "
-            f"<u>{url}</u> <m>{code}</m></b> <m>{length}</m>"
+            f"<u>{url}</u> <m>{code}</m></b> <m>{length}</m> "
+            f"<d>{response.http_version}</d>"
         )
 
-    @Retry(exceptions=[TransportError])
-    async def request(self, method: str, url: Union[URL, str], **kwargs):
+    async def send(self, request: Request, **kwargs):
         self.event_hooks = {
             "request": [self._log_request],
             "response": [self._log_response],
         }
+        return await super().send(request, **kwargs)
+
+    @Retry(exceptions=[TransportError])
+    async def request(self, method: str, url: Union[URL, str], **kwargs):
         return await super().request(method, url, **kwargs)
 
 
@@ -74,11 +80,13 @@ class BaseNetClient:
         headers: Optional[Dict[str, Any]] = None,
         cookies: Optional[Cookies] = None,
         proxies: Optional[Dict[str, str]] = None,
+        limits: Optional[Limits] = None,
         client_class: Type[AsyncHTTPClient] = AsyncHTTPClient,
     ):
         self.cookies, self.client_class = cookies or Cookies(), client_class
         self.headers: Dict[str, Any] = headers or {}
         self.proxies: Any = proxies or {}  # Bypass type checker
+        self.limits = limits or DEFAULT_LIMITS
 
         self.create_client()
 
@@ -87,6 +95,7 @@ class BaseNetClient:
             headers=self.headers,
             proxies=self.proxies,
             cookies=self.cookies,
+            limits=self.limits,
             http2=True,
             follow_redirects=True,
         )
@@ -0,0 +1,48 @@
+import asyncio
+from datetime import timedelta
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from hibiapi.utils.cache import cache_config, revalidating
+from hibiapi.utils.routing import BaseEndpoint, request_headers, response_headers
+
+
+class StaleEndpoint(BaseEndpoint):
+    calls = 0
+
+    @cache_config(ttl=timedelta(seconds=1), stale=timedelta(seconds=5))
+    async def counter(self, *, key: str = "stale"):
+        StaleEndpoint.calls += 1
+        return {"calls": StaleEndpoint.calls}
+
+
+async def _call(endpoint: StaleEndpoint):
+    response_headers.set(MutableHeaders())
+    result = await endpoint.counter()
+    return result, response_headers.get().get("Cache-Control")
+
+
+def test_stale_while_revalidate():
+    async def main():
+        request_headers.set(Headers())
+        endpoint = StaleEndpoint(None)  # type:ignore
+
+        result, cache_control = await _call(endpoint)
+        assert result == {"calls": 1}
+        assert cache_control is not None and cache_control.startswith("max-age=")
+
+        await asyncio.sleep(1.5)
+
+        # expired but still within the stale window, served while refreshing
+        result, cache_control = await _call(endpoint)
+        assert result == {"calls": 1}
+        assert cache_control is None
+        assert revalidating
+
+        await asyncio.gather(*revalidating.values())
+
+        result, cache_control = await _call(endpoint)
+        assert result == {"calls": 2}
+        assert cache_control is not None and cache_control.startswith("max-age=")
+
+    asyncio.run(main())
@@ -1,6 +1,10 @@
+import asyncio
+import gc
+import json
 from datetime import date, timedelta
 from math import inf
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from pytest_benchmark.fixture import BenchmarkFixture
@@ -87,6 +91,14 @@ def test_ugoira_metadata(client: TestClient):
     assert response.json().get("ugoira_metadata")
 
 
+def test_illust_bundle(client: TestClient):
+    response = client.get("illust_bundle", params={"id": 85162550})
+    assert response.status_code == 200
+    assert response.json()["illust"].get("illust")
+    assert response.json()["related"].get("illusts") is not None
+    assert response.json()["ugoira"].get("ugoira_metadata")
+
+
 def test_member_novel(client: TestClient):
     response = client.get("member_novel", params={"id": 14883165})
     assert response.status_code == 200
@@ -165,3 +177,139 @@ def test_rate_limit(client: TestClient):
     second_response = client.get("rank")
     assert second_response.status_code == 429
     assert "retry-after" in second_response.headers
+
+
+def offline_endpoints(handler):
+    from starlette.datastructures import Headers, MutableHeaders
+
+    from hibiapi.api.pixiv import NetRequest, PixivEndpoints
+    from hibiapi.utils.net import AsyncHTTPClient
+    from hibiapi.utils.routing import request_headers, response_headers
+
+    net = NetRequest()
+    client = AsyncHTTPClient(
+        headers=net.headers, transport=httpx.MockTransport(handler)
+    )
+    client.net_client = net
+
+    request_headers.set(Headers({"cache-control": "no-store"}))
+    response_headers.set(MutableHeaders())
+    return PixivEndpoints(client)
+
+
+def test_request_coalescing():
+    from hibiapi.api.pixiv.api import _inflight_requests
+
+    calls = []
+
+    async def handler(request: httpx.Request):
+        calls.append(request.url)
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, json={"illust": {"id": 1}})
+
+    async def main():
+        endpoints = offline_endpoints(handler)
+        requests = (
+            endpoints.request("v1/illust/detail", params={"illust_id": 1})
+            for _ in range(5)
+        )
+        return await asyncio.gather(*requests)
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [{"illust": {"id": 1}}] * 5
+    assert not _inflight_requests
+
+
+def test_request_coalescing_cancelled():
+    from hibiapi.api.pixiv.api import _inflight_requests
+
+    errors = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: errors.append(context)
+        )
+        release = asyncio.Event()
+
+        async def handler(request: httpx.Request):
+            await release.wait()
+            return httpx.Response(200, content=b"not json")
+
+        endpoints = offline_endpoints(handler)
+        waiters = [
+            asyncio.ensure_future(
+                endpoints.request("v1/illust/detail", params={"illust_id": 2})
+            )
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.05)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+        release.set()
+        while _inflight_requests:
+            await asyncio.sleep(0.01)
+        gc.collect()
+
+    asyncio.run(main())
+    assert not errors
+
+
+def test_request_unhashable_params():
+    seen = []
+
+    def handler(request: httpx.Request):
+        seen.append(request.url.params.get_list("viewed"))
+        return httpx.Response(200, json={"illusts": []})
+
+    async def main():
+        endpoints = offline_endpoints(handler)
+        return await endpoints.illust_recommended(
+            params=json.dumps({"filter": "for_ios", "viewed": [1, 2]})
+        )
+
+    assert asyncio.run(main()) == {"illusts": []}
+    assert seen == [["1", "2"]]
+
+
+class ChunkedBody(httpx.AsyncByteStream):
+    def __init__(self, data: bytes, size: int):
+        self.data, self.size, self.sent = data, size, 0
+
+    async def __aiter__(self):
+        for offset in range(0, len(self.data), self.size):
+            self.sent += 1
+            yield self.data[offset : offset + self.size]
+
+
+def test_webview_novel_stream():
+    novel = {"id": 1, "text": "前文 isOwnWork: true, 后文", "isOwnWork": False}
+    page = (
+        "<script>pixiv = {novel: "
+        + json.dumps(novel, ensure_ascii=False)
+        + ", isOwnWork: false};</script>"
+    ).encode() + b"<p></p>" * 2000
+    # isOwnWork never lines up with a chunk, so every match spans two chunks
+    body = ChunkedBody(page, size=4)
+
+    async def main():
+        endpoints = offline_endpoints(lambda _: httpx.Response(200, stream=body))
+        return await endpoints.webview_novel(id=1)
+
+    assert asyncio.run(main()) == novel
+    # Reading stops once the payload is decoded, before the trailing markup
+    assert body.sent < len(page) // body.size / 2
+
+
+def test_webview_novel_stream_without_payload():
+    body = ChunkedBody(b"<html><body>isOwnWork novel: []</body></html>", size=4)
+
+    async def main():
+        endpoints = offline_endpoints(lambda _: httpx.Response(200, stream=body))
+        return await endpoints.webview_novel(id=2)
+
+    assert asyncio.run(main()) == {
+        "error": "Parse novel error: novel payload not found"
+    }